@@ -1,107 +1,296 @@
-import sqlite3
-from datetime import datetime, timedelta
+import asyncio
+import logging
+import time
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
 from typing import Any
 
+import aiosqlite
+from cachetools import TTLCache
+
 DB_FILE = "cache.db"
+CACHE_TTL_MINUTES = 60
+
+DEFAULT_SITES = (
+    "https://realpython.com/search/?q=",
+    "https://medium.com/search?q=",
+    "https://stackoverflow.com/search?q=",
+)
+
+# One long-lived connection shared by every helper, opened by init_db().
+# It runs in autocommit mode, so multi-statement work is wrapped in an
+# explicit BEGIN/COMMIT (see _transaction). Any statement run on the
+# connection while a transaction is open becomes part of it, so every write
+# goes through _TX_LOCK, either via _transaction or via _write.
+_CONN: aiosqlite.Connection | None = None
+_TX_LOCK = asyncio.Lock()
+
+# save_cache only queues rows; _cache_writer flushes them in batches of up to
+# CACHE_BATCH_SIZE rows or every CACHE_BATCH_DELAY seconds. None stops it.
+CACHE_BATCH_SIZE = 200
+CACHE_BATCH_DELAY = 0.2
+_CACHE_QUEUE: asyncio.Queue[tuple[str, str, int] | None] = asyncio.Queue()
+_CACHE_WRITER: asyncio.Task[None] | None = None
+
+# Hot cache entries kept in memory as query -> (created_at, response)
+_MEM: TTLCache[str, tuple[float, str]] = TTLCache(maxsize=1024, ttl=CACHE_TTL_MINUTES * 60)
+
+# Per-user site lists; writers below drop the user's entry after changing it
+_SITES_MEM: TTLCache[int, tuple[str, ...]] = TTLCache(maxsize=4096, ttl=300)
+
+def _conn() -> aiosqlite.Connection:
+    """Return the shared connection, failing loudly if init_db() was not awaited."""
+    if _CONN is None:
+        raise RuntimeError("Database is not initialized; await init_db() first.")
+    return _CONN
+
+@asynccontextmanager
+async def _transaction() -> AsyncIterator[aiosqlite.Connection]:
+    """Run the enclosed statements as one transaction on the shared connection."""
+    conn = _conn()
+    async with _TX_LOCK:
+        await conn.execute("BEGIN")
+        try:
+            yield conn
+        except BaseException:
+            await conn.execute("ROLLBACK")
+            raise
+        await conn.execute("COMMIT")
 
-def init_db() -> None:
-    """Initialize the database for caching, user sites, and subscriptions."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
+async def _write(sql: str, params: tuple[Any, ...] = ()) -> None:
+    """Run a single write statement outside any open transaction."""
+    async with _TX_LOCK:
+        await _conn().execute(sql, params)
+
+async def _write_cache_batch(batch: list[tuple[str, str, int]]) -> None:
+    """Write queued cache rows in one transaction."""
+    try:
+        async with _transaction() as tx:
+            await tx.executemany("INSERT OR REPLACE INTO cache (query, response, created_at) VALUES (?, ?, ?)", batch)
+    except aiosqlite.Error as e:
+        logging.error("Error writing %d cache rows: %s", len(batch), e)
+
+async def _cache_writer() -> None:
+    """Drain the cache write queue until a None sentinel arrives."""
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await _CACHE_QUEUE.get()
+        if item is None:
+            return
+        batch = [item]
+        stop = False
+        deadline = loop.time() + CACHE_BATCH_DELAY
+        while len(batch) < CACHE_BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(_CACHE_QUEUE.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+        await _write_cache_batch(batch)
+        if stop:
+            return
+
+async def _create_keyed_table(conn: aiosqlite.Connection, table: str, columns: str, key: str) -> None:
+    """Create a table with PRIMARY KEY(key), rebuilding an older keyless copy without its duplicate rows."""
+    async with conn.execute(f"PRAGMA table_info({table})") as cursor:
+        existing = await cursor.fetchall()
+    if existing and not any(row[5] for row in existing):
+        async with _transaction() as tx:
+            await tx.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+            await tx.execute(f"CREATE TABLE {table} ({columns}, PRIMARY KEY({key}))")
+            await tx.execute(f"INSERT OR IGNORE INTO {table} ({key}) SELECT {key} FROM {table}_old ORDER BY rowid")
+            await tx.execute(f"DROP TABLE {table}_old")
+    else:
+        await conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({columns}, PRIMARY KEY({key}))")
+
+async def init_db() -> None:
+    """Initialize the database for caching, user sites, subscriptions, and preferences."""
+    global _CONN, _CACHE_WRITER
+    if _CONN is None:
+        _CONN = await aiosqlite.connect(DB_FILE, isolation_level=None)
+    conn = _CONN
+    await conn.execute("PRAGMA journal_mode=WAL")
+    await conn.execute("PRAGMA synchronous=NORMAL")
+    await conn.execute("PRAGMA temp_store=MEMORY")
+    await conn.execute("PRAGMA cache_size=-64000")
+    await conn.execute("PRAGMA busy_timeout=5000")
+    await conn.execute("PRAGMA mmap_size=268435456")
+    # Older databases have a cache table without a key on query; it only holds
+    # disposable cached responses, so rebuild it instead of migrating rows
+    async with conn.execute("PRAGMA table_info(cache)") as cursor:
+        columns = {row[1]: row[5] for row in await cursor.fetchall()}
+    if columns and not columns.get("query"):
+        await conn.execute("DROP TABLE cache")
+    await conn.execute("""
         CREATE TABLE IF NOT EXISTS cache (
-            query TEXT,
+            query TEXT PRIMARY KEY,
             response TEXT,
-            created_at TIMESTAMP
+            created_at INTEGER
         )
     """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS user_sites (
-            user_id INTEGER,
-            site_url TEXT
+    await conn.execute("CREATE INDEX IF NOT EXISTS ix_cache_created_at ON cache(created_at)")
+    # Summaries are looked up by the short token in /find's buttons; older
+    # tables are keyed on the query instead and only hold disposable rows
+    async with conn.execute("PRAGMA table_info(summaries)") as cursor:
+        columns = {row[1]: row[5] for row in await cursor.fetchall()}
+    if columns and not columns.get("token"):
+        await conn.execute("DROP TABLE summaries")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS summaries (
+            token TEXT PRIMARY KEY,
+            query TEXT,
+            summary TEXT,
+            created_at INTEGER
         )
     """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS subscriptions (
-            user_id INTEGER,
-            query TEXT
+    # Older databases let repeated commands duplicate these rows
+    await _create_keyed_table(conn, "user_sites", "user_id INTEGER, site_url TEXT", "user_id, site_url")
+    await _create_keyed_table(conn, "subscriptions", "user_id INTEGER, query TEXT", "user_id, query")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_prefs (
+            user_id INTEGER PRIMARY KEY,
+            lang TEXT
         )
     """)
-    conn.commit()
-    conn.close()
-
-def save_cache(query: str, response: str) -> None:
-    """Save a response to the cache."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO cache VALUES (?, ?, ?)",
-        (query, response, datetime.now())
-    )
-    conn.commit()
-    conn.close()
+    if _CACHE_WRITER is None:
+        _CACHE_WRITER = asyncio.create_task(_cache_writer())
+
+async def close_db() -> None:
+    """Flush pending cache writes and close the shared connection."""
+    global _CONN, _CACHE_WRITER
+    if _CACHE_WRITER is not None:
+        _CACHE_QUEUE.put_nowait(None)
+        await _CACHE_WRITER
+        _CACHE_WRITER = None
+    if _CONN is not None:
+        await _CONN.close()
+        _CONN = None
+
+async def save_cache(query: str, response: str) -> None:
+    """Save a response to the cache; the database write happens in the next batch."""
+    now = int(time.time())
+    _MEM[query] = (now, response)
+    await _CACHE_QUEUE.put((query, response, now))
 
-def load_cache(query: str, ttl_minutes: int = 60) -> Any | None:
+async def load_cache(query: str, ttl_minutes: int = CACHE_TTL_MINUTES) -> Any | None:
     """Load a response from the cache if it's still valid."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT response, created_at FROM cache WHERE query = ? ORDER BY created_at DESC LIMIT 1",
+    hit = _MEM.get(query)
+    if hit and time.time() - hit[0] < ttl_minutes * 60:
+        return hit[1]
+
+    async with _conn().execute(
+        "SELECT response, created_at FROM cache WHERE query = ?",
         (query,)
+    ) as cursor:
+        row = await cursor.fetchone()
+    if row and time.time() - row[1] < ttl_minutes * 60:
+        _MEM[query] = (row[1], row[0])
+        return row[0]
+    return None
+
+async def save_summary(token: str, query: str, summary: str) -> None:
+    """Save the conclusion of a response under a short token so it can be copied without re-parsing."""
+    await _write(
+        "INSERT OR REPLACE INTO summaries (token, query, summary, created_at) VALUES (?, ?, ?, ?)",
+        (token, query, summary, int(time.time()))
     )
-    row = cursor.fetchone()
-    conn.close()
-    if row:
-        try:
-            saved_time = datetime.strptime(str(row[1]), "%Y-%m-%d %H:%M:%S.%f")
-        except ValueError:
-            saved_time = datetime.strptime(str(row[1]), "%Y-%m-%d %H:%M:%S")
-        if datetime.now() - saved_time < timedelta(minutes=ttl_minutes):
-            return row[0]
+
+async def load_summary(token: str, ttl_minutes: int = CACHE_TTL_MINUTES) -> tuple[str, str] | None:
+    """Load the query and conclusion saved under a token if they're still valid."""
+    async with _conn().execute("SELECT query, summary, created_at FROM summaries WHERE token = ?", (token,)) as cursor:
+        row = await cursor.fetchone()
+    if row and time.time() - row[2] < ttl_minutes * 60:
+        return row[0], row[1]
     return None
 
-def get_user_sites(user_id: int) -> list[str]:
+async def prune_cache(ttl_minutes: int = CACHE_TTL_MINUTES) -> None:
+    """Delete cached responses and summaries older than the TTL."""
+    cutoff = int(time.time()) - ttl_minutes * 60
+    async with _transaction() as tx:
+        await tx.execute("DELETE FROM cache WHERE created_at < ?", (cutoff,))
+        await tx.execute("DELETE FROM summaries WHERE created_at < ?", (cutoff,))
+
+async def prune_cache_periodically(interval_minutes: int = 5) -> None:
+    """Prune expired cache rows every few minutes until cancelled."""
+    while True:
+        await asyncio.sleep(interval_minutes * 60)
+        try:
+            await prune_cache()
+        except aiosqlite.Error as e:
+            logging.error("Error pruning cache: %s", e)
+
+async def get_user_sites(user_id: int) -> list[str]:
     """Retrieve the list of sites for a specific user."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT site_url FROM user_sites WHERE user_id = ?", (user_id,))
-    rows = cursor.fetchall()
-    conn.close()
-
-    if not rows:
-        # Add default sites if user has no custom sites
-        default_sites = ["https://realpython.com/search/?q=", "https://medium.com/search?q=", "https://stackoverflow.com/search?q="]
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.executemany("INSERT INTO user_sites (user_id, site_url) VALUES (?, ?)", [(user_id, site) for site in default_sites])
-        conn.commit()
-        conn.close()
-        return default_sites
+    cached = _SITES_MEM.get(user_id)
+    if cached is not None:
+        return list(cached)
 
-    return [row[0] for row in rows]
+    async with _conn().execute("SELECT site_url FROM user_sites WHERE user_id = ? ORDER BY rowid", (user_id,)) as cursor:
+        rows = await cursor.fetchall()
 
-def add_user_site(user_id: int, site_url: str) -> None:
+    # Users without rows of their own search the default sites
+    sites = tuple(row[0] for row in rows) or DEFAULT_SITES
+    _SITES_MEM[user_id] = sites
+    return list(sites)
+
+async def _seed_default_sites(tx: aiosqlite.Connection, user_id: int) -> None:
+    """Store the default sites for a user who has no rows yet, so edits apply to them."""
+    async with tx.execute("SELECT 1 FROM user_sites WHERE user_id = ? LIMIT 1", (user_id,)) as cursor:
+        if await cursor.fetchone():
+            return
+    await tx.executemany("INSERT OR IGNORE INTO user_sites (user_id, site_url) VALUES (?, ?)", [(user_id, site) for site in DEFAULT_SITES])
+
+async def add_user_site(user_id: int, site_url: str) -> None:
     """Add a new site to the user's list."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO user_sites (user_id, site_url) VALUES (?, ?)", (user_id, site_url))
-    conn.commit()
-    conn.close()
+    async with _transaction() as tx:
+        await _seed_default_sites(tx, user_id)
+        await tx.execute("INSERT OR IGNORE INTO user_sites (user_id, site_url) VALUES (?, ?)", (user_id, site_url))
+    _SITES_MEM.pop(user_id, None)
 
-def remove_user_site(user_id: int, site_url: str) -> None:
+async def remove_user_site(user_id: int, site_url: str) -> None:
     """Remove a site from the user's list."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM user_sites WHERE user_id = ? AND site_url = ?", (user_id, site_url))
-    conn.commit()
-    conn.close()
+    async with _transaction() as tx:
+        await _seed_default_sites(tx, user_id)
+        await tx.execute("DELETE FROM user_sites WHERE user_id = ? AND site_url = ?", (user_id, site_url))
+    _SITES_MEM.pop(user_id, None)
 
-def reset_user_sites(user_id: int) -> None:
+async def reset_user_sites(user_id: int) -> None:
     """Reset the user's site list to default."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM user_sites WHERE user_id = ?", (user_id,))
-    default_sites = ["https://realpython.com/search/?q=", "https://medium.com/search?q=", "https://stackoverflow.com/search?q="]
-    cursor.executemany("INSERT INTO user_sites (user_id, site_url) VALUES (?, ?)", [(user_id, site) for site in default_sites])
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    await _write("DELETE FROM user_sites WHERE user_id = ?", (user_id,))
+    _SITES_MEM.pop(user_id, None)
+
+async def add_subscription(user_id: int, query: str) -> None:
+    """Add a subscription for a user."""
+    await _write("INSERT OR IGNORE INTO subscriptions (user_id, query) VALUES (?, ?)", (user_id, query))
+
+async def remove_subscription(user_id: int, query: str) -> None:
+    """Remove a subscription for a user."""
+    await _write("DELETE FROM subscriptions WHERE user_id = ? AND query = ?", (user_id, query))
+
+async def get_subscriptions(user_id: int) -> list[str]:
+    """Get all subscriptions for a user."""
+    async with _conn().execute("SELECT query FROM subscriptions WHERE user_id = ?", (user_id,)) as cursor:
+        rows = await cursor.fetchall()
+    return [row[0] for row in rows]
+
+async def get_all_subscriptions() -> list[tuple[int, str]]:
+    """Get every (user_id, query) subscription pair."""
+    async with _conn().execute("SELECT user_id, query FROM subscriptions") as cursor:
+        rows = await cursor.fetchall()
+    return [(row[0], row[1]) for row in rows]
+
+async def get_user_languages() -> dict[int, str]:
+    """Get the saved language of every user who picked one."""
+    async with _conn().execute("SELECT user_id, lang FROM user_prefs") as cursor:
+        rows = await cursor.fetchall()
+    return {row[0]: row[1] for row in rows}
+
+async def save_user_language(user_id: int, lang: str) -> None:
+    """Save a user's preferred language."""
+    await _write("INSERT OR REPLACE INTO user_prefs (user_id, lang) VALUES (?, ?)", (user_id, lang))
\ No newline at end of file
@@ -16,7 +16,7 @@ async def subscribe_handler(message: types.Message, command: CommandObject):
         await message.reply(get_response(user_id, "Please provide a query to subscribe. Example: /subscribe Python", "Будь ласка, вкажіть запит для підписки. Наприклад: /subscribe Python"))
         return
 
-    add_subscription(user_id, query)
+    await add_subscription(user_id, query)
     await message.reply(get_response(user_id, f"You have successfully subscribed to: {query}", f"Ви успішно підписалися на запит: {query}"))
 
 async def unsubscribe_handler(message: types.Message, command: CommandObject):
@@ -31,7 +31,7 @@ async def unsubscribe_handler(message: types.Message, command: CommandObject):
         await message.reply(get_response(user_id, "Please provide a query to unsubscribe. Example: /unsubscribe Python", "Будь ласка, вкажіть запит для відписки. Наприклад: /unsubscribe Python"))
         return
 
-    remove_subscription(user_id, query)
+    await remove_subscription(user_id, query)
     await message.reply(get_response(user_id, f"You have successfully unsubscribed from: {query}", f"Ви успішно відписалися від запиту: {query}"))
 
 async def subscriptions_handler(message: types.Message):
@@ -41,7 +41,7 @@ async def subscriptions_handler(message: types.Message):
         await message.reply("Не удалось определить ваш идентификатор пользователя.")
         return
 
-    subscriptions = get_subscriptions(user_id)
+    subscriptions = await get_subscriptions(user_id)
     if not subscriptions:
         await message.reply(get_response(user_id, "You have no active subscriptions.", "У вас немає активних підписок."))
         return
@@ -1,4 +1,16 @@
-user_languages = {}
+from .database import get_user_languages, save_user_language
+
+# Warm copy of the user_prefs table, so get_response never touches the database
+user_languages: dict[int, str] = {}
+
+async def load_user_languages() -> None:
+    """Fill the in-memory language map from the database at startup."""
+    user_languages.update(await get_user_languages())
+
+async def set_user_language(user_id: int, lang: str) -> None:
+    """Remember a user's language choice in memory and in the database."""
+    user_languages[user_id] = lang
+    await save_user_language(user_id, lang)
 
 def get_response(user_id: int, en_text: str, uk_text: str) -> str:
     """Return the response text in the user's preferred language."""
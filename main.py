@@ -2,7 +2,8 @@ import logging
 import asyncio
 from aiogram import Bot, Dispatcher
 from bot.config import API_TOKEN
-from bot.database import init_db
+from bot.database import init_db, close_db, prune_cache_periodically
+from bot.localization import load_user_languages
 from bot.handlers import subscribe_handler, unsubscribe_handler, subscriptions_handler
 from aiogram.filters import Command
 
@@ -18,8 +19,14 @@ dp.message.register(subscriptions_handler, Command("subscriptions"))
 
 async def main() -> None:
     """Start the bot."""
-    init_db()
-    await dp.start_polling(bot)
+    await init_db()
+    await load_user_languages()
+    pruner = asyncio.create_task(prune_cache_periodically())
+    try:
+        await dp.start_polling(bot)
+    finally:
+        pruner.cancel()
+        await close_db()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -7,22 +7,38 @@ import logging
 import re
 import os
 import asyncio
+import hashlib
+import heapq
 import sqlite3
-from datetime import datetime, timedelta
+import time
 from collections import Counter
-from typing import Any
+from collections.abc import Awaitable, Callable
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice, zip_longest
+from urllib.parse import quote_plus, urlsplit
 
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramAPIError
 from aiogram.filters import Command, CommandObject
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 import aiohttp
-from bs4 import BeautifulSoup
-from newspaper import Article  # type: ignore
-import openai
-from openai import OpenAIError
+from aiohttp_client_cache import CachedSession, SQLiteBackend
+from selectolax.lexbor import LexborHTMLParser
+import trafilatura
+from openai import AsyncOpenAI, OpenAIError
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from cachetools import TTLCache
+import tiktoken
+
+from bot.database import (
+    init_db, close_db, save_cache, load_cache, save_summary, load_summary, prune_cache_periodically,
+    DEFAULT_SITES, get_user_sites, add_user_site, remove_user_site, reset_user_sites,
+    add_subscription, remove_subscription, get_subscriptions, get_all_subscriptions,
+)
+from bot.localization import get_response, load_user_languages, set_user_language
 
 # ================== CONFIG ==================
 load_dotenv()
@@ -32,155 +48,54 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if not API_TOKEN:
     raise ValueError("API_TOKEN not found in .env")
 
+aclient: AsyncOpenAI | None = None
 if not OPENAI_API_KEY or OPENAI_API_KEY == "YOUR_OPENAI_API_KEY_HERE":
     logging.warning("OPENAI_API_KEY not found in .env or is a placeholder. Falling back to basic summarizer.")
-    openai.api_key = None
 else:
-    openai.api_key = OPENAI_API_KEY
+    # Bound each completion so a hung API call cannot stall /find indefinitely
+    aclient = AsyncOpenAI(api_key=OPENAI_API_KEY, timeout=15, max_retries=2)
 
 logging.basicConfig(level=logging.INFO)
-bot = Bot(token=API_TOKEN)
+# Replies are Markdown without link previews unless a call says otherwise;
+# user or scraped text is either escaped with md_escape() or sent with parse_mode=None
+bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN, link_preview_is_disabled=True))
 dp = Dispatcher()
-DB_FILE = "cache.db"
 
-SITES = {
-    "realpython": "https://realpython.com/search/?q={}",
-    "medium": "https://medium.com/search?q={}",
-    "stackoverflow": "https://stackoverflow.com/search?q={}"
-}
+_URL_RE = re.compile(r'https?://[\w.-]+')
+_SENT_SPLIT_RE = re.compile(r'(?<=[.!?]) +')
+_MD_SPECIAL_RE = re.compile(r'([_*`\[])')
 
-scheduler = AsyncIOScheduler()
+CALLBACK_DATA_LIMIT = 64  # bytes Telegram allows in a button's callback_data
 
-# ================== DATABASE ==================
-def init_db() -> None:
-    """Initialize the database for caching, user sites, and subscriptions."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS cache (
-            query TEXT,
-            response TEXT,
-            created_at TIMESTAMP
-        )
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS user_sites (
-            user_id INTEGER,
-            site_url TEXT
-        )
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS subscriptions (
-            user_id INTEGER,
-            query TEXT
-        )
-    """)
-    conn.commit()
-    conn.close()
-
-def save_cache(query: str, response: str) -> None:
-    """Save a response to the cache."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO cache VALUES (?, ?, ?)",
-        (query, response, datetime.now())
-    )
-    conn.commit()
-    conn.close()
-
-def load_cache(query: str, ttl_minutes: int = 60) -> Any | None:
-    """Load a response from the cache if it's still valid."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT response, created_at FROM cache WHERE query = ? ORDER BY created_at DESC LIMIT 1",
-        (query,)
-    )
-    row = cursor.fetchone()
-    conn.close()
-    if row:
-        try:
-            saved_time = datetime.strptime(str(row[1]), "%Y-%m-%d %H:%M:%S.%f")
-        except ValueError:
-            saved_time = datetime.strptime(str(row[1]), "%Y-%m-%d %H:%M:%S")
-        if datetime.now() - saved_time < timedelta(minutes=ttl_minutes):
-            return row[0]
-    return None
-
-def get_user_sites(user_id: int) -> list[str]:
-    """Retrieve the list of sites for a specific user."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT site_url FROM user_sites WHERE user_id = ?", (user_id,))
-    rows = cursor.fetchall()
-    conn.close()
-
-    if not rows:
-        # Add default sites if user has no custom sites
-        default_sites = ["https://realpython.com/search/?q=", "https://medium.com/search?q=", "https://stackoverflow.com/search?q="]
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.executemany("INSERT INTO user_sites (user_id, site_url) VALUES (?, ?)", [(user_id, site) for site in default_sites])
-        conn.commit()
-        conn.close()
-        return default_sites
-
-    return [row[0] for row in rows]
-
-def add_user_site(user_id: int, site_url: str) -> None:
-    """Add a new site to the user's list."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO user_sites (user_id, site_url) VALUES (?, ?)", (user_id, site_url))
-    conn.commit()
-    conn.close()
-
-def remove_user_site(user_id: int, site_url: str) -> None:
-    """Remove a site from the user's list."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM user_sites WHERE user_id = ? AND site_url = ?", (user_id, site_url))
-    conn.commit()
-    conn.close()
-
-def reset_user_sites(user_id: int) -> None:
-    """Reset the user's site list to default."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM user_sites WHERE user_id = ?", (user_id,))
-    default_sites = ["https://realpython.com/search/?q=", "https://medium.com/search?q=", "https://stackoverflow.com/search?q="]
-    cursor.executemany("INSERT INTO user_sites (user_id, site_url) VALUES (?, ?)", [(user_id, site) for site in default_sites])
-    conn.commit()
-    conn.close()
+# Search URL of each host whose result pages _scrape_links knows how to read
+SEARCH_URLS = {urlsplit(site).netloc.removeprefix("www."): site for site in DEFAULT_SITES}
 
-# ================== SUBSCRIPTIONS ==================
-# Database functions for subscriptions
-def add_subscription(user_id: int, query: str) -> None:
-    """Add a subscription for a user."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO subscriptions (user_id, query) VALUES (?, ?)", (user_id, query))
-    conn.commit()
-    conn.close()
-
-def remove_subscription(user_id: int, query: str) -> None:
-    """Remove a subscription for a user."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM subscriptions WHERE user_id = ? AND query = ?", (user_id, query))
-    conn.commit()
-    conn.close()
-
-def get_subscriptions(user_id: int) -> list[str]:
-    """Get all subscriptions for a user."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT query FROM subscriptions WHERE user_id = ?", (user_id,))
-    rows = cursor.fetchall()
-    conn.close()
-    return [row[0] for row in rows]
+SUMMARY_MODEL = "gpt-3.5-turbo"
+MAX_PROMPT_TOKENS = 3000
+MAX_PROMPT_CHARS = 12000  # split evenly between the articles sent for summarizing
+SUMMARY_EDIT_INTERVAL = 1.0  # seconds between streamed summary edits
+
+# Search results per (search URL, query), so "Show all sources" reuses what /find fetched
+SEARCH_CACHE: TTLCache[tuple[str, str], list[str]] = TTLCache(maxsize=1024, ttl=600)
+
+# Shared HTTP client, opened in main() so keep-alive connections and DNS
+# lookups are reused across handlers; GET responses are cached on disk and
+# expired ones are purged by prune_http_cache_periodically()
+HTTP_CACHE_FILE = ".http_cache.sqlite"
+SESSION: CachedSession | None = None
+
+# Dedicated workers for CPU-bound article extraction, so it can't starve the default executor
+ARTICLE_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="article")
+
+# /find searches in progress by query, shared by concurrent identical requests
+INFLIGHT: dict[str, asyncio.Task[tuple[str, str | None]]] = {}
+
+# Strong references to fire-and-forget tasks so they aren't garbage collected mid-run
+BACKGROUND_TASKS: set[asyncio.Task[None]] = set()
+
+scheduler = AsyncIOScheduler()
 
+# ================== SUBSCRIPTIONS ==================
 # Command handlers
 @dp.message(Command("subscribe"))
 async def subscribe_handler(message: types.Message, command: CommandObject):
@@ -195,8 +110,8 @@ async def subscribe_handler(message: types.Message, command: CommandObject):
         await message.reply(get_response(user_id, "Please provide a query to subscribe. Example: /subscribe Python", "Будь ласка, вкажіть запит для підписки. Наприклад: /subscribe Python"))
         return
 
-    add_subscription(user_id, query)
-    await message.reply(get_response(user_id, f"You have successfully subscribed to: {query}", f"Ви успішно підписалися на запит: {query}"))
+    await add_subscription(user_id, query)
+    await message.reply(get_response(user_id, f"You have successfully subscribed to: {query}", f"Ви успішно підписалися на запит: {query}"), parse_mode=None)
 
 @dp.message(Command("unsubscribe"))
 async def unsubscribe_handler(message: types.Message, command: CommandObject):
@@ -211,8 +126,8 @@ async def unsubscribe_handler(message: types.Message, command: CommandObject):
         await message.reply(get_response(user_id, "Please provide a query to unsubscribe. Example: /unsubscribe Python", "Будь ласка, вкажіть запит для відписки. Наприклад: /unsubscribe Python"))
         return
 
-    remove_subscription(user_id, query)
-    await message.reply(get_response(user_id, f"You have successfully unsubscribed from: {query}", f"Ви успішно відписалися від запиту: {query}"))
+    await remove_subscription(user_id, query)
+    await message.reply(get_response(user_id, f"You have successfully unsubscribed from: {query}", f"Ви успішно відписалися від запиту: {query}"), parse_mode=None)
 
 @dp.message(Command("subscriptions"))
 async def subscriptions_handler(message: types.Message):
@@ -222,122 +137,233 @@ async def subscriptions_handler(message: types.Message):
         await message.reply("Не удалось определить ваш идентификатор пользователя.")
         return
 
-    subscriptions = get_subscriptions(user_id)
+    subscriptions = await get_subscriptions(user_id)
     if not subscriptions:
         await message.reply(get_response(user_id, "You have no active subscriptions.", "У вас немає активних підписок."))
         return
 
     subscriptions_list = "\n".join(subscriptions)
-    await message.reply(get_response(user_id, f"Your subscriptions:\n{subscriptions_list}", f"Ваші підписки:\n{subscriptions_list}"))
+    await message.reply(get_response(user_id, f"Your subscriptions:\n{subscriptions_list}", f"Ваші підписки:\n{subscriptions_list}"), parse_mode=None)
 
 # Scheduled task
+async def notify_subscriber(user_id: int, query: str, session: aiohttp.ClientSession, sem: asyncio.Semaphore) -> None:
+    """Search for new articles for one subscription and send them to the user."""
+    async with sem:
+        sites = await get_user_sites(user_id)
+        site_results = await asyncio.gather(*[search_links(site, query, session) for site in sites])
+        all_links = list(chain.from_iterable(site_results))
+
+        if all_links:
+            header = get_response(user_id, f"🔔 New articles for '{query}':", f"🔔 Нові статті за запитом '{query}':")
+            message = "\n".join([header, *all_links[:5]])
+            try:
+                await bot.send_message(chat_id=user_id, text=message, parse_mode=None)
+            except Exception as e:
+                logging.error(f"Failed to send message to user {user_id}: {e}")
+
 async def check_subscriptions():
     """Check for new articles for all subscriptions."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT DISTINCT user_id, query FROM subscriptions")
-    subscriptions = cursor.fetchall()
-    conn.close()
-
-    async with aiohttp.ClientSession() as session:
-        for user_id, query in subscriptions:
-            site_results = await asyncio.gather(*[search_links(site, query, session) for site in SITES])
-            all_links = [link for sublist in site_results for link in sublist]
-
-            if all_links:
-                message = get_response(user_id, f"🔔 New articles for '{query}':\n", f"🔔 Нові статті за запитом '{query}':\n")
-                message += "\n".join(all_links[:5])
-                try:
-                    await bot.send_message(chat_id=user_id, text=message)
-                except Exception as e:
-                    logging.error(f"Failed to send message to user {user_id}: {e}")
-
-# Initialize scheduler
-scheduler.add_job(check_subscriptions, "interval", hours=24)
-scheduler.start()
+    subscriptions = await get_all_subscriptions()
+
+    session = http_session()
+    # Subscriptions are independent; cap concurrency to stay under Telegram's rate limits
+    sem = asyncio.Semaphore(20)
+    results = await asyncio.gather(
+        *[notify_subscriber(user_id, query, session, sem) for user_id, query in subscriptions],
+        return_exceptions=True
+    )
+    for (user_id, query), result in zip(subscriptions, results):
+        if isinstance(result, Exception):
+            logging.error("Failed to check subscription %r for user %s: %s", query, user_id, result)
 
 # ================== PARSING ==================
-async def fetch_article(url: str) -> tuple[str | None, str | None]:
-    """Parse an article using newspaper3k."""
-    loop = asyncio.get_event_loop()
+def http_session() -> CachedSession:
+    """Return the shared HTTP session, failing loudly if main() has not opened it."""
+    if SESSION is None:
+        raise RuntimeError("HTTP session is not initialized; start the bot via main().")
+    return SESSION
+
+async def prune_http_cache_periodically(interval_minutes: int = 5) -> None:
+    """Delete expired cached HTTP responses every few minutes until cancelled."""
+    while True:
+        await asyncio.sleep(interval_minutes * 60)
+        try:
+            await http_session().cache.delete_expired_responses()
+        except sqlite3.Error as e:
+            logging.error("Error pruning HTTP cache: %s", e)
+
+def search_url(site_url: str) -> tuple[str, bool]:
+    """Turn a site URL into the search URL stored for it, and say whether /find can read its results.
+
+    Known hosts map to their real search page; any other URL is kept as a search
+    prefix the query is appended to.
+    """
+    host = urlsplit(site_url).netloc.removeprefix("www.")
+    if host in SEARCH_URLS:
+        return SEARCH_URLS[host], True
+    if site_url.endswith("="):
+        return site_url, False
+    return site_url + ("&q=" if "?" in site_url else "?q="), False
+
+def _extract_article(html: str) -> tuple[str | None, str]:
+    """Pull the page title and main text out of already downloaded HTML."""
+    title_node = LexborHTMLParser(html).css_first("title")
+    title = title_node.text(strip=True) if title_node else None
+    text = trafilatura.extract(html, include_comments=False, include_tables=False) or ""
+    return title, text
+
+async def fetch_article(url: str, session: aiohttp.ClientSession, sem: asyncio.Semaphore) -> tuple[str | None, str | None]:
+    """Download an article over the shared session and extract it using trafilatura."""
+    loop = asyncio.get_running_loop()
     try:
-        article = await loop.run_in_executor(None, lambda: Article(url))
-        await loop.run_in_executor(None, article.download)
-        await loop.run_in_executor(None, article.parse)
-        text = article.text.strip().replace("\n", " ")
-        return article.title, text
-    except (ValueError, IOError) as e:
+        async with sem:
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                if response.status != 200:
+                    return None, None
+                html = await response.text()
+        # A page that takes trafilatura too long can't hold the caller; the worker finishes on its own
+        title, text = await asyncio.wait_for(loop.run_in_executor(ARTICLE_POOL, _extract_article, html), timeout=10)
+        return title, text.strip().replace("\n", " ")
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, IOError) as e:
         logging.error("Error parsing %s: %s", url, e)
         return None, None
 
 async def search_links(site: str, query: str, session: aiohttp.ClientSession) -> list[str]:
-    """Search for links on a site."""
-    search_url = SITES[site].format(query.replace(" ", "+"))
+    """Search for links on a site (a search URL the query is appended to), reusing recent results."""
+    key = (site, query)
+    cached = SEARCH_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    links = await _scrape_links(site, query, session)
+    # Failed or empty searches are retried next time instead of being cached
+    if links:
+        SEARCH_CACHE[key] = links
+    return links
+
+async def _scrape_links(site: str, query: str, session: aiohttp.ClientSession) -> list[str]:
+    """Fetch a site's search page and extract result links."""
+    host = urlsplit(site).netloc.removeprefix("www.")
+    if host not in SEARCH_URLS:
+        # Custom sites have no result selectors, so there is nothing to extract
+        return []
+
+    search_url = site + quote_plus(query)
     try:
-        async with session.get(search_url, headers={"User-Agent": "Mozilla/5.0"}) as response:
+        async with session.get(search_url) as response:
             if response.status != 200:
                 return []
             text = await response.text()
-            soup = BeautifulSoup(text, "html.parser")
+            tree = LexborHTMLParser(text)
             links: list[str] = []
 
-            if site == "realpython":
-                results = soup.select(".card-title a")  # type: ignore
-                for a in results[:5]:
-                    href = a.get("href")
+            if host == "realpython.com":
+                for a in tree.css(".card-title a")[:5]:
+                    href = a.attributes.get("href")
                     if href:
-                        links.append("https://realpython.com" + str(href))
-            elif site == "medium":
-                results = soup.find_all("a", href=re.compile(r"https://medium.com/.*"))  # type: ignore
-                unique_links = list(dict.fromkeys([str(a.get("href", "")).split("?")[0] for a in results if a.get("href")]))
+                        links.append("https://realpython.com" + href)
+            elif host == "medium.com":
+                hrefs = (a.attributes.get("href") for a in tree.css("a[href]"))
+                unique_links = list(dict.fromkeys(href.split("?")[0] for href in hrefs if href and href.startswith("https://medium.com/")))
                 links = unique_links[:5]
-            elif site == "stackoverflow":
-                results = soup.select(".s-post-summary--content .s-link")  # type: ignore
-                for a in results[:5]:
-                    href = a.get("href")
+            elif host == "stackoverflow.com":
+                for a in tree.css(".s-post-summary--content .s-link")[:5]:
+                    href = a.attributes.get("href")
                     if href:
-                        links.append("https://stackoverflow.com" + str(href))
+                        links.append("https://stackoverflow.com" + href)
 
             return links
-    except aiohttp.ClientError as e:
+    # The session's total timeout raises TimeoutError, which isn't a ClientError
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         logging.error("Error searching on %s: %s", site, e)
         return []
 
 # ================== SUMMARY ==================
-async def get_ai_summary(texts: list[str], query: str) -> str:
-    """Generate a summary using OpenAI's GPT."""
-    if not openai.api_key:
+# The summary model's tokenizer, loaded by load_encoding() in main(); None if it couldn't be loaded
+ENCODING: tiktoken.Encoding | None = None
+
+async def load_encoding() -> None:
+    """Load the tokenizer off the event loop, since the first call may download its BPE file."""
+    global ENCODING
+    try:
+        ENCODING = await asyncio.to_thread(tiktoken.encoding_for_model, SUMMARY_MODEL)
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning("Could not load the %s tokenizer, truncating prompts by length: %s", SUMMARY_MODEL, e)
+
+def truncate_to_tokens(text: str, max_tokens: int = MAX_PROMPT_TOKENS) -> str:
+    """Cut text down to at most max_tokens tokens of the summary model."""
+    if ENCODING is None:
+        # English text averages about 4 characters per token
+        return text[:max_tokens * 4]
+    # A token is rarely longer than 8 characters, so don't tokenize text that would be dropped anyway
+    text = text[:max_tokens * 8]
+    tokens = ENCODING.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return ENCODING.decode(tokens[:max_tokens])
+
+def dedupe_texts(texts: list[str]) -> list[str]:
+    """Drop sentences already seen earlier in the articles, e.g. from mirrored posts."""
+    seen: set[bytes] = set()
+    unique_texts: list[str] = []
+    for txt in texts:
+        kept: list[str] = []
+        for sentence in _SENT_SPLIT_RE.split(txt):
+            normalized = " ".join(sentence.lower().split())
+            if not normalized:
+                continue
+            digest = hashlib.blake2b(normalized.encode(), digest_size=8).digest()
+            if digest in seen:
+                continue
+            seen.add(digest)
+            kept.append(sentence)
+        if kept:
+            unique_texts.append(" ".join(kept))
+    return unique_texts
+
+async def get_ai_summary(
+    texts: list[str],
+    query: str,
+    on_update: Callable[[str], Awaitable[None]] | None = None,
+) -> str:
+    """Generate a summary using OpenAI's GPT, streaming partial text to on_update."""
+    if aclient is None:
         logging.warning("OpenAI API key not set. Falling back to basic summarizer.")
         return summarize_texts(texts)
 
-    full_text = "\n\n".join(texts)
-    # Truncate to avoid exceeding token limits
-    max_length = 12000  # Roughly 3000 tokens
-    if len(full_text) > max_length:
-        full_text = full_text[:max_length]
-
     try:
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: openai.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant that summarizes texts."},
-                    {"role": "user", "content": f"Based on the following articles, provide a concise summary of the key findings regarding '{query}'. The summary should be a single, coherent paragraph of 3-5 sentences. Here is the text:\n\n{full_text}"}
-                ],
-                temperature=0.5,
-                max_tokens=150,
-                top_p=1.0,
-                frequency_penalty=0.0,
-                presence_penalty=0.0
-            )
+        # Give every article an equal share of the prompt so late sources aren't
+        # cut off entirely, then truncate to avoid exceeding token limits
+        unique_texts = dedupe_texts(texts)
+        budget = MAX_PROMPT_CHARS // max(len(unique_texts), 1)
+        full_text = truncate_to_tokens("\n\n".join(text[:budget] for text in unique_texts))
+        stream = await aclient.chat.completions.create(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": "You are a helpful assistant that summarizes texts."},
+                {"role": "user", "content": f"Based on the following articles, provide a concise summary of the key findings regarding '{query}'. The summary should be a single, coherent paragraph of 3-5 sentences. Here is the text:\n\n{full_text}"}
+            ],
+            temperature=0.5,
+            max_tokens=150,
+            top_p=1.0,
+            frequency_penalty=0.0,
+            presence_penalty=0.0,
+            stream=True
         )
-        if response.choices:
-            choice_content = response.choices[0].message.content if response.choices[0].message.content else ""
-            return choice_content.strip()
-        return "Could not generate an AI summary."
-    except (OpenAIError, ValueError, TypeError) as e:
+        parts: list[str] = []
+        last_update = time.monotonic()
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            parts.append(delta)
+            # Telegram rate-limits edits, so push partial text at most once per interval
+            if on_update and time.monotonic() - last_update >= SUMMARY_EDIT_INTERVAL:
+                last_update = time.monotonic()
+                await on_update("".join(parts))
+        summary = "".join(parts).strip()
+        return summary or "Could not generate an AI summary."
+    except (OpenAIError, OSError, ValueError, TypeError) as e:
         logging.error("Error calling OpenAI API: %s", e)
         return "Failed to generate AI summary. Falling back to basic method."
 
@@ -345,20 +371,23 @@ def summarize_texts(texts: list[str], max_sentences: int = 3) -> str:
     """Create a short summary based on article texts (basic fallback)."""
     sentences: list[str] = []
     for txt in texts:
-        parts = re.split(r'(?<=[.!?]) +', txt)
+        parts = _SENT_SPLIT_RE.split(txt)
         sentences.extend(parts)
 
     if not sentences:
         return "Could not generate a short summary."
 
-    word_freq = Counter(" ".join(sentences).lower().split())
-    ranked = sorted(sentences, key=lambda s: sum(word_freq.get(w, 0) for w in s.lower().split()), reverse=True)
-    summary = " ".join(ranked[:max_sentences])
+    # Tokenize each sentence once and reuse the tokens for counting and scoring
+    tokens_per_sent = [s.lower().split() for s in sentences]
+    word_freq = Counter(chain.from_iterable(tokens_per_sent))
+    # map() keeps the per-word lookups in C instead of a Python-level generator
+    scores = [sum(map(word_freq.__getitem__, tokens)) for tokens in tokens_per_sent]
+    top = heapq.nlargest(max_sentences, range(len(sentences)), key=scores.__getitem__)
+    # Keep the chosen sentences in reading order so the summary flows like the source
+    summary = " ".join(sentences[i] for i in sorted(top))
     return summary.strip()
 
 # ================== LANGUAGE SUPPORT ==================
-user_languages = {}
-
 @dp.message(Command("start", "help"))
 async def start_handler(message: types.Message):
     """Handle the /start and /help commands to display a welcome message and language options."""
@@ -381,7 +410,7 @@ async def set_language(callback_query: types.CallbackQuery):
         return
 
     lang = callback_query.data.split(":")[1]
-    user_languages[callback_query.from_user.id] = lang
+    await set_user_language(callback_query.from_user.id, lang)
     if lang == "en":
         if callback_query.message:
             await callback_query.message.reply("Language set to English.")
@@ -390,88 +419,137 @@ async def set_language(callback_query: types.CallbackQuery):
             await callback_query.message.reply("Мова змінена на українську.")
     await callback_query.answer()
 
-# Modify responses to use the selected language
-def get_response(user_id: int, en_text: str, uk_text: str) -> str:
-    """Return the response text in the user's preferred language."""
-    lang = user_languages.get(user_id, "en")
-    return en_text if lang == "en" else uk_text
-
 # ================== BOT HANDLERS ==================
 @dp.message(Command("find"))
 async def find_handler(message: types.Message, command: CommandObject) -> None:
-    query = command.args
+    # Collapse whitespace so the query never contains the newlines cache_key() joins with
+    query = " ".join((command.args or "").split())
     if not query:
         await message.reply(
             "Please enter a query after the command.\nExample: `/find best python frameworks`"
         )
         return
 
-    cached = load_cache(query)
+    user_id = message.from_user.id if message.from_user else None
+    sites = await sites_for(user_id)
+    key = cache_key(query, sites)
+    cached = await load_cache(key)
     if cached:
-        await message.reply(cached, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+        await message.reply(cached)
         return
 
     msg = await message.reply("⏳ Searching for information, please wait...")
 
-    async with aiohttp.ClientSession() as session:
-        site_results = await asyncio.gather(*[search_links(site, query, session) for site in SITES])
+    async def show_partial_summary(partial: str) -> None:
+        try:
+            await msg.edit_text(f"✅ Conclusion:\n{partial}…", parse_mode=None)
+        # A throttled or failed edit only loses the preview, never the search
+        except (TelegramAPIError, aiohttp.ClientError) as e:
+            logging.warning("Could not show partial summary: %s", e)
+
+    # Identical queries arriving while a search is running wait for that search instead of starting their own
+    task = INFLIGHT.get(key)
+    leader = task is None
+    if task is None:
+        task = asyncio.create_task(build_find_response(query, sites, show_partial_summary))
+        INFLIGHT[key] = task
+        task.add_done_callback(lambda _: INFLIGHT.pop(key, None))
+    # Shield so one caller going away doesn't cancel the search for the others
+    response, summary = await asyncio.shield(task)
+
+    if summary is None:
+        await msg.edit_text(response)
+        return
+
+    if leader:
+        # Write the cache in the background, and before the reply so a failed edit can't lose it
+        store = asyncio.create_task(store_find_result(key, response, summary))
+        BACKGROUND_TASKS.add(store)
+        store.add_done_callback(BACKGROUND_TASKS.discard)
+
+    await msg.edit_text(text=response, reply_markup=find_keyboard(find_token(key)))
+
+async def store_find_result(key: str, response: str, summary: str) -> None:
+    """Cache a /find response and its conclusion."""
+    await save_cache(key, response)
+    await save_summary(find_token(key), key, summary)
+
+def find_token(key: str) -> str:
+    """Return a short id for a /find cache key, used in button data instead of the query."""
+    return hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+
+def find_keyboard(token: str) -> InlineKeyboardMarkup | None:
+    """Build the buttons under a /find answer, leaving out any whose data Telegram would reject."""
+    buttons = [("📄 Show all sources", f"sources:{token}"), ("📋 Copy conclusion", f"copy:{token}")]
+    rows = [
+        [InlineKeyboardButton(text=text, callback_data=data)]
+        for text, data in buttons
+        if len(data.encode()) <= CALLBACK_DATA_LIMIT
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=rows) if rows else None
+
+async def sites_for(user_id: int | None) -> list[str]:
+    """Return the search URLs to use for a user, or the defaults if the sender is unknown."""
+    return await get_user_sites(user_id) if user_id else list(DEFAULT_SITES)
+
+def cache_key(query: str, sites: list[str]) -> str:
+    """Key cached /find results by query and, for customized site lists, by the sites searched."""
+    if tuple(sites) == DEFAULT_SITES:
+        return query
+    return "\n".join([query, *sites])
+
+def split_cache_key(key: str) -> tuple[str, list[str]]:
+    """Recover the query and the sites searched from a cache_key() result."""
+    query, *sites = key.split("\n")
+    return query, sites or list(DEFAULT_SITES)
+
+def md_escape(text: str) -> str:
+    """Escape Telegram Markdown characters so outside text can't break or restyle a reply."""
+    return _MD_SPECIAL_RE.sub(r"\\\1", text)
+
+async def build_find_response(query: str, sites: list[str], on_update: Callable[[str], Awaitable[None]]) -> tuple[str, str | None]:
+    """Search the given sites, then fetch and summarize articles for a query.
+
+    Returns the reply text and the conclusion; the conclusion is None when the
+    text is an error message instead of a formatted answer.
+    """
+    session = http_session()
+    site_results = await asyncio.gather(*[search_links(site, query, session) for site in sites])
 
     # Збираємо посилання по черзі з усіх сайтів
-    all_links: list[str] = []
     max_links = 5
-    index = 0
-    while len(all_links) < max_links:
-        added = False
-        for site_links in site_results:
-            if index < len(site_links):
-                all_links.append(site_links[index])
-                added = True
-                if len(all_links) >= max_links:
-                    break
-        if not added:
-            break
-        index += 1
+    interleaved = chain.from_iterable(zip_longest(*site_results))
+    all_links: list[str] = list(islice((link for link in interleaved if link), max_links))
 
     if not all_links:
-        await msg.edit_text("Could not find any articles. Try another topic.")
-        return
+        return "Could not find any articles. Try another topic.", None
 
-    article_tasks = [fetch_article(link) for link in all_links]
+    sem = asyncio.Semaphore(5)
+    article_tasks = [fetch_article(link, session, sem) for link in all_links]
     articles = await asyncio.gather(*article_tasks)
 
-    ideas: list[str] = []
-    texts: list[str] = []
-    for (title, text), link in zip(articles, all_links):
-        if title and text:
-            snippet = " ".join(text.split()[:30])
-            ideas.append(f"*{title}*:\n{snippet}... [Read]({link})")
-            texts.append(text)
-
-    if not ideas:
-        await msg.edit_text("Could not extract content from the pages.")
-        return
-
-    summary = await get_ai_summary(texts, query) if openai.api_key else summarize_texts(texts)
-
-    response = f"🔎 *Query:* {query}\n\n"
-    response += "🔍 *Key Ideas:*\n" + "\n\n".join(f"- {idea}" for idea in ideas) + "\n\n"
-    response += f"✅ *Conclusion:*\n{summary}"
-
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="📄 Show all sources", callback_data=f"sources:{query}")],
-            [InlineKeyboardButton(text="📋 Copy conclusion", callback_data=f"copy:{query}")]
-        ]
-    )
+    parsed = [(title, text, link) for (title, text), link in zip(articles, all_links) if title and text]
+    if not parsed:
+        return "Could not extract content from the pages.", None
 
-    await msg.edit_text(
-        text=response,
-        parse_mode=ParseMode.MARKDOWN,
-        reply_markup=kb,
-        disable_web_page_preview=True
-    )
+    texts = [text for _, text, _ in parsed]
+    # Start the (slow) OpenAI call first and format the key ideas while it runs
+    summary_task = asyncio.create_task(get_ai_summary(texts, query, on_update)) if aclient else None
 
-    save_cache(query, response)
+    ideas: list[str] = []
+    for title, text, link in parsed:
+        snippet = " ".join(islice(text.split(maxsplit=30), 30))
+        # Nothing can be escaped inside the bold title, so just drop its asterisks
+        ideas.append(f"*{title.replace('*', '')}*:\n{md_escape(snippet)}... [Read]({link})")
+    key_ideas = "\n\n".join(f"- {idea}" for idea in ideas)
+
+    summary = await summary_task if summary_task else summarize_texts(texts)
+    response = "\n\n".join([
+        f"🔎 *Query:* {md_escape(query)}",
+        f"🔍 *Key Ideas:*\n{key_ideas}",
+        f"✅ *Conclusion:*\n{md_escape(summary)}",
+    ])
+    return response, summary
 
 @dp.callback_query(F.data.startswith("sources:"))
 async def show_sources(callback_query: types.CallbackQuery) -> None:
@@ -479,20 +557,26 @@ async def show_sources(callback_query: types.CallbackQuery) -> None:
     if not msg or not isinstance(msg, types.Message) or not callback_query.data:
         await callback_query.answer("Message not found or data is missing.", show_alert=True)
         return
-    query = callback_query.data.split(":", 1)[1]
-
-    async with aiohttp.ClientSession() as session:
-        tasks = [search_links(site, query, session) for site in SITES]
-        results = await asyncio.gather(*tasks)
-    all_links = [link for sublist in results for link in sublist]
+    # The token names the /find that made the button, so this is that search's
+    # query and sites even when someone else in a group clicks it
+    found = await load_summary(callback_query.data.split(":", 1)[1])
+    if not found:
+        await msg.reply("Sources not found. The cache might have expired.")
+        await callback_query.answer()
+        return
+    query, sites = split_cache_key(found[0])
+    session = http_session()
+    tasks = [search_links(site, query, session) for site in sites]
+    results = await asyncio.gather(*tasks)
+    all_links = list(chain.from_iterable(results))
 
     if not all_links:
         await msg.reply("Could not find sources for this query.")
         await callback_query.answer()
         return
 
-    text = "📄 *Sources:*\n" + "\n".join(f"{i}. {link}" for i, link in enumerate(all_links, 1))
-    await msg.reply(text, parse_mode=ParseMode.MARKDOWN)
+    text = "\n".join(["📄 *Sources:*", *(f"{i}. {md_escape(link)}" for i, link in enumerate(all_links, 1))])
+    await msg.reply(text)
     await callback_query.answer()
 
 @dp.callback_query(F.data.startswith("copy:"))
@@ -501,12 +585,9 @@ async def copy_summary(callback_query: types.CallbackQuery) -> None:
     if not msg or not isinstance(msg, types.Message) or not callback_query.data:
         await callback_query.answer("Message not found or data is missing.", show_alert=True)
         return
-    query = callback_query.data.split(":", 1)[1]
-
-    cached = load_cache(query)
-    if cached:
-        summary = str(cached).split("✅ *Conclusion:*", 1)[-1].strip()
-        await msg.reply(f"📋 Copied:\n\n```{summary}```", parse_mode=ParseMode.MARKDOWN)
+    found = await load_summary(callback_query.data.split(":", 1)[1])
+    if found:
+        await msg.reply(f"📋 Copied:\n\n```{found[1]}```")
     else:
         await msg.reply("Conclusion not found. The cache might have expired.")
     await callback_query.answer()
@@ -519,95 +600,144 @@ async def add_site_handler(message: types.Message, command: CommandObject) -> No
         await message.reply("Please provide a valid site URL after the command.\nExample: `/addsite https://example.com`")
         return
 
-    if not re.match(r'https?://[\w.-]+', site_url):
+    if not _URL_RE.match(site_url):
         await message.reply("Invalid URL format. Please provide a valid site URL.")
         return
 
+    session = http_session()
     try:
         timeout = aiohttp.ClientTimeout(total=5)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(site_url) as response:
-                if response.status != 200:
-                    await message.reply(f"The site `{site_url}` is not reachable (status code: {response.status}). Please check the URL.")
-                    return
-    except aiohttp.ClientError as e:
-        await message.reply(f"Failed to reach the site `{site_url}`. Error: {str(e)}")
+        # Ask the site itself; a cached copy says nothing about whether it is still up
+        async with session.disabled(), session.get(site_url, timeout=timeout) as response:
+            if response.status != 200:
+                await message.reply(f"The site {site_url} is not reachable (status code: {response.status}). Please check the URL.", parse_mode=None)
+                return
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        await message.reply(f"Failed to reach the site {site_url}. Error: {str(e)}", parse_mode=None)
         return
 
-    SITES[site_url] = site_url + "?q={}"
-    await message.reply(f"The site `{site_url}` has been added successfully! You can now use `/find` to search it.")
+    if not message.from_user:
+        await message.reply("Could not determine your user ID.")
+        return
 
-# ================== FIXING ERRORS ==================
-from aiogram import types, Dispatcher
-from aiogram.types import Message
+    url, scraped = search_url(site_url)
+    await add_user_site(message.from_user.id, url)
+    if scraped:
+        await message.reply(f"The site {site_url} has been added successfully as {url}! You can now use /find to search it.", parse_mode=None)
+    else:
+        await message.reply(
+            f"The site {site_url} has been added to your list as {url}, but the bot can't read its search results yet, "
+            "so /find won't return articles from it.",
+            parse_mode=None
+        )
 
-# Fixing the decorator usage
-@dp.message(commands=['add_source'])
-async def add_source(message: Message):
+# ================== SITE LIST ==================
+@dp.message(Command("add_source"))
+async def add_source(message: types.Message, command: CommandObject):
     """Handle the /add_source command to add a new site."""
     user_id = message.from_user.id if message.from_user else None
     if not user_id:
         await message.reply("Не вдалося визначити ваш ідентифікатор користувача.")
         return
 
-    args = message.text.split(maxsplit=1)
-    if len(args) < 2:
-        await message.reply("Пожалуйста, укажите URL сайта после команды. Пример: /add_source https://example.com")
+    if not command.args:
+        await message.reply("Пожалуйста, укажите URL сайта после команды. Пример: /add_source https://example.com", parse_mode=None)
         return
 
-    site_url = args[1].strip()
-    add_user_site(user_id, site_url)
-    await message.reply(f"Сайт {site_url} успішно додано до вашого списку.")
+    site_url = command.args.strip()
+    if not _URL_RE.match(site_url):
+        await message.reply("Невірний формат URL. Приклад: /add_source https://example.com", parse_mode=None)
+        return
 
-@dp.message(commands=['my_sources'])
-async def my_sources(message: Message):
+    url, scraped = search_url(site_url)
+    await add_user_site(user_id, url)
+    if scraped:
+        await message.reply(f"Сайт {url} успішно додано до вашого списку.", parse_mode=None)
+    else:
+        await message.reply(
+            f"Сайт {url} додано до вашого списку, але бот поки не вміє читати його результати пошуку, "
+            "тому /find не знайде на ньому статей.",
+            parse_mode=None
+        )
+
+@dp.message(Command("my_sources"))
+async def my_sources(message: types.Message):
     """Handle the /my_sources command to list user sites."""
     user_id = message.from_user.id if message.from_user else None
     if not user_id:
         await message.reply("Не вдалося визначити ваш ідентифікатор користувача.")
         return
 
-    sites = get_user_sites(user_id)
+    sites = await get_user_sites(user_id)
     if not sites:
         await message.reply("Ваш список сайтів пустий.")
         return
 
     sites_list = "\n".join(sites)
-    await message.reply(f"Ваші сайти:\n{sites_list}")
+    await message.reply(f"Ваші сайти:\n{sites_list}", parse_mode=None)
 
-@dp.message(commands=['remove_source'])
-async def remove_source(message: Message):
+@dp.message(Command("remove_source"))
+async def remove_source(message: types.Message, command: CommandObject):
     """Handle the /remove_source command to remove a site."""
     user_id = message.from_user.id if message.from_user else None
     if not user_id:
         await message.reply("Не вдалося визначити ваш ідентифікатор користувача.")
         return
 
-    args = message.text.split(maxsplit=1)
-    if len(args) < 2:
-        await message.reply("Будь ласка, вкажіть URL сайту для видалення. Приклад: /remove_source https://example.com")
+    if not command.args:
+        await message.reply("Будь ласка, вкажіть URL сайту для видалення. Приклад: /remove_source https://example.com", parse_mode=None)
         return
 
-    site_url = args[1].strip()
-    remove_user_site(user_id, site_url)
-    await message.reply(f"Сайт {site_url} успішно видалено з вашого списку.")
+    site_url = command.args.strip()
+    url, _ = search_url(site_url)
+    await remove_user_site(user_id, url)
+    if site_url != url:
+        # Rows added before site URLs were normalized hold the URL as typed
+        await remove_user_site(user_id, site_url)
+    await message.reply(f"Сайт {site_url} успішно видалено з вашого списку.", parse_mode=None)
 
-@dp.message(commands=['reset_sources'])
-async def reset_sources(message: Message):
+@dp.message(Command("reset_sources"))
+async def reset_sources(message: types.Message):
     """Handle the /reset_sources command to reset user sites to default."""
     user_id = message.from_user.id if message.from_user else None
     if not user_id:
         await message.reply("Не вдалося визначити ваш ідентифікатор користувача.")
         return
 
-    reset_user_sites(user_id)
+    await reset_user_sites(user_id)
     await message.reply("Ваш список сайтів був скинутий до налаштувань за замовчуванням.")
 
 # ================== RUN ==================
 async def main() -> None:
     """Start the bot."""
-    init_db()
-    await dp.start_polling(bot)
+    global SESSION
+    await init_db()
+    await load_user_languages()
+    await load_encoding()
+    SESSION = CachedSession(
+        # Honor the sites' own Cache-Control/Expires headers where they send them
+        cache=SQLiteBackend(HTTP_CACHE_FILE, expire_after=600, cache_control=True),
+        connector=aiohttp.TCPConnector(limit=100, limit_per_host=10, ttl_dns_cache=300, keepalive_timeout=60),
+        timeout=aiohttp.ClientTimeout(total=15),
+        headers={"User-Agent": "Mozilla/5.0"},
+    )
+    pruner = asyncio.create_task(prune_cache_periodically())
+    http_pruner = asyncio.create_task(prune_http_cache_periodically())
+    # Started here so the job runs on the polling loop and uses SESSION; missed
+    # runs after downtime collapse into one and a slow run never overlaps the next
+    scheduler.add_job(check_subscriptions, "interval", hours=24, coalesce=True, max_instances=1, misfire_grace_time=3600)
+    scheduler.start()
+    try:
+        await dp.start_polling(bot)
+    finally:
+        scheduler.shutdown(wait=False)
+        pruner.cancel()
+        http_pruner.cancel()
+        await SESSION.close()
+        ARTICLE_POOL.shutdown(wait=False, cancel_futures=True)
+        # Let deferred /find cache writes land before the connection closes
+        await asyncio.gather(*BACKGROUND_TASKS, return_exceptions=True)
+        await close_db()
 
 if __name__ == "__main__":
     asyncio.run(main())
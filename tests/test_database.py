@@ -0,0 +1,119 @@
+import asyncio
+import importlib
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+from cachetools import TTLCache
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bot import database
+
+
+@pytest.fixture
+def db_file(tmp_path, monkeypatch):
+    """Point the database module at a fresh file with fresh module state."""
+    path = tmp_path / "cache.db"
+    monkeypatch.setattr(database, "DB_FILE", str(path))
+    # The queue and lock bind to the first event loop that waits on them, and each test runs its own loop
+    monkeypatch.setattr(database, "_CACHE_QUEUE", asyncio.Queue())
+    monkeypatch.setattr(database, "_TX_LOCK", asyncio.Lock())
+    monkeypatch.setattr(database, "_MEM", TTLCache(maxsize=1024, ttl=database.CACHE_TTL_MINUTES * 60))
+    monkeypatch.setattr(database, "_SITES_MEM", TTLCache(maxsize=4096, ttl=300))
+    return path
+
+
+@pytest.fixture
+def superbot(monkeypatch):
+    """Import the bot module with a dummy token."""
+    monkeypatch.setenv("API_TOKEN", "123456:TEST")
+    monkeypatch.setenv("OPENAI_API_KEY", "")
+    monkeypatch.delitem(sys.modules, "superbot", raising=False)
+    return importlib.import_module("superbot")
+
+
+def test_write_during_rolled_back_transaction_is_kept(db_file):
+    """A write issued while another coroutine's transaction is open survives that transaction's rollback."""
+    async def run():
+        await database.init_db()
+        try:
+            async def failing_transaction():
+                async with database._transaction() as tx:
+                    await tx.execute("INSERT INTO cache (query, response, created_at) VALUES ('q', 'r', 0)")
+                    await asyncio.sleep(0.05)
+                    raise RuntimeError("rollback")
+
+            results = await asyncio.gather(
+                failing_transaction(),
+                database.save_user_language(42, "uk"),
+                return_exceptions=True,
+            )
+            assert isinstance(results[0], RuntimeError)
+            return await database.get_user_languages(), await database.load_cache("q")
+        finally:
+            await database.close_db()
+
+    languages, cached = asyncio.run(run())
+
+    assert languages == {42: "uk"}
+    assert cached is None
+
+
+def test_init_db_rebuilds_keyless_tables(db_file):
+    """Legacy user_sites/subscriptions tables get a primary key, losing only duplicate rows."""
+    with sqlite3.connect(db_file) as conn:
+        conn.execute("CREATE TABLE user_sites (user_id INTEGER, site_url TEXT)")
+        conn.executemany(
+            "INSERT INTO user_sites VALUES (?, ?)",
+            [(1, "https://b.example/?q="), (1, "https://a.example/?q="), (1, "https://b.example/?q="), (2, "https://c.example/?q=")],
+        )
+        conn.execute("CREATE TABLE subscriptions (user_id INTEGER, query TEXT)")
+        conn.executemany("INSERT INTO subscriptions VALUES (?, ?)", [(1, "python"), (1, "python"), (2, "rust")])
+
+    async def run():
+        await database.init_db()
+        try:
+            return (
+                await database.get_user_sites(1),
+                await database.get_user_sites(2),
+                await database.get_all_subscriptions(),
+            )
+        finally:
+            await database.close_db()
+
+    sites_1, sites_2, subscriptions = asyncio.run(run())
+
+    assert sites_1 == ["https://b.example/?q=", "https://a.example/?q="]
+    assert sites_2 == ["https://c.example/?q="]
+    assert sorted(subscriptions) == [(1, "python"), (2, "rust")]
+    with sqlite3.connect(db_file) as conn:
+        for table, key in (("user_sites", ["user_id", "site_url"]), ("subscriptions", ["user_id", "query"])):
+            columns = conn.execute(f"PRAGMA table_info({table})").fetchall()
+            assert [row[1] for row in sorted(columns, key=lambda row: row[5]) if row[5]] == key
+        with pytest.raises(sqlite3.IntegrityError):
+            conn.execute("INSERT INTO user_sites VALUES (1, 'https://a.example/?q=')")
+
+
+def test_cache_key_round_trips(superbot):
+    """cache_key() keys default searches by query alone and split_cache_key() recovers query and sites."""
+    defaults = list(superbot.DEFAULT_SITES)
+    custom = ["https://example.com/search?q="]
+
+    assert superbot.cache_key("python", defaults) == "python"
+    assert superbot.split_cache_key(superbot.cache_key("python", defaults)) == ("python", defaults)
+    assert superbot.split_cache_key(superbot.cache_key("2024: trends", custom)) == ("2024: trends", custom)
+
+
+def test_find_buttons_fit_callback_data_limit(superbot):
+    """Button data holds a fixed-size token, so long non-ASCII queries stay under Telegram's limit."""
+    key = superbot.cache_key("найкращі фреймворки для python " * 5, ["https://example.com/search?q="])
+    token = superbot.find_token(key)
+
+    keyboard = superbot.find_keyboard(token)
+
+    assert token == superbot.find_token(key)
+    data = [row[0].callback_data for row in keyboard.inline_keyboard]
+    assert data == [f"sources:{token}", f"copy:{token}"]
+    assert all(len(d.encode()) <= superbot.CALLBACK_DATA_LIMIT for d in data)
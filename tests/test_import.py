@@ -0,0 +1,17 @@
+import importlib
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+def test_superbot_imports(monkeypatch):
+    """superbot loads under aiogram 3 and registers its command handlers."""
+    monkeypatch.setenv("API_TOKEN", "123456:TEST")
+    monkeypatch.setenv("OPENAI_API_KEY", "")
+    monkeypatch.delitem(sys.modules, "superbot", raising=False)
+
+    superbot = importlib.import_module("superbot")
+
+    assert superbot.dp.message.handlers
+    assert not superbot.scheduler.running